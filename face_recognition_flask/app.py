@@ -1,27 +1,37 @@
 import os
+# config caps the native thread pools, so it must be imported before numpy/cv2/torch
+from config import Config
+import cv2
+import numpy as np
 from flask import Flask, request, jsonify, send_from_directory
-from werkzeug.utils import secure_filename
 import uuid
 import json # For handling roll number assignment data
 import shutil # For moving files
 
 # Import your modules
-from config import Config
-from face_utils import detect_and_crop_faces, recognize_faces_in_photo
-from train import augment_faces, train_siamese_network_for_classroom
+from face_utils import detect_and_crop_faces, recognize_faces_in_photo, invalidate_model_cache, warmup_models
+from train import train_siamese_network_for_classroom
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
 # --- Helper functions ---
-# In your allowed_file function
 def allowed_file(filename):
-    if not '.' in filename:
-        return False
-    # Get the part after the last dot, and add a leading dot back
-    ext = '.' + filename.rsplit('.', 1)[1].lower()
+    # Extension including the leading dot, e.g. ".jpg"
+    ext = os.path.splitext(filename)[1].lower()
     return ext in app.config['ALLOWED_EXTENSIONS']
 
+def decode_uploaded_image(file):
+    """Decodes an uploaded image in memory into a BGR array. Returns None if it is not a valid image."""
+    buf = np.frombuffer(file.stream.read(), np.uint8)
+    if buf.size == 0:
+        return None
+    return cv2.imdecode(buf, cv2.IMREAD_COLOR)
+
+def enhance_requested():
+    """Whether the request opted into the slower enhanced (two-pass) detection via `?enhance=1`."""
+    return request.args.get('enhance', '0').lower() in ('1', 'true', 'yes')
+
 def classroom_model_exists(classroom_id):
     """Checks if a trained model exists for the given classroom ID."""
     model_path = os.path.join(app.config['MODELS_FOLDER'], classroom_id, 'siamese_model_best.pth')
@@ -45,17 +55,14 @@ def detect_faces_api(classroom_id):
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        # Save to a temporary upload folder
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        # Decode the upload in memory instead of round-tripping through the upload folder
+        img_bgr = decode_uploaded_image(file)
+        if img_bgr is None:
+            return jsonify({"error": "Could not decode the uploaded image"}), 400
 
         try:
             # Call the detection utility function
-            face_data = detect_and_crop_faces(filepath, classroom_id)
-            
-            # Remove the uploaded group photo after processing
-            os.remove(filepath)
+            face_data = detect_and_crop_faces(img_bgr, classroom_id, enhance=enhance_requested())
 
             if not face_data:
                 return jsonify({"message": "No faces detected in the photo.", "faces": []}), 200
@@ -76,9 +83,6 @@ def detect_faces_api(classroom_id):
                 "faces": response_faces
             }), 200
         except Exception as e:
-            # Clean up the uploaded file in case of an error
-            if os.path.exists(filepath):
-                os.remove(filepath)
             app.logger.error(f"Error during face detection for {classroom_id}: {e}", exc_info=True)
             return jsonify({"error": f"Internal server error during face detection: {str(e)}"}), 500
     else:
@@ -150,25 +154,18 @@ def train_model_api(classroom_id):
     try:
         # Collect all labeled images for this classroom
         labeled_faces_dir = os.path.join(app.config['DATASETS_FOLDER'], classroom_id, "labeled_faces")
-        if not os.path.exists(labeled_faces_dir) or not os.listdir(labeled_faces_dir):
+        if not os.path.exists(labeled_faces_dir):
             return jsonify({"error": f"No labeled faces found for classroom {classroom_id}. Please assign roll numbers first."}), 400
 
-        # Prepare face_data for augmentation (list of dicts with 'image_path' and 'label')
-        face_data_for_augmentation = []
-        for filename in os.listdir(labeled_faces_dir):
-            if filename.lower().endswith(app.config['ALLOWED_EXTENSIONS']):
-                label = os.path.splitext(filename)[0]
-                face_data_for_augmentation.append({'image_path': os.path.join(labeled_faces_dir, filename), 'label': label})
+        with os.scandir(labeled_faces_dir) as entries:
+            has_labeled_faces = any(entry.is_file() and allowed_file(entry.name) for entry in entries)
 
-        if not face_data_for_augmentation:
+        if not has_labeled_faces:
             return jsonify({"error": f"No valid labeled face images found in {labeled_faces_dir}."}), 400
 
-        # Step 1: Augment faces
-        augmented_data = augment_faces(face_data_for_augmentation, classroom_id)
-        
-        # Step 2: Train the model
-        # train_siamese_network_for_classroom will handle combining original and augmented data internally
+        # Train the model; augmentation happens on the fly inside training
         training_result = train_siamese_network_for_classroom(classroom_id)
+        invalidate_model_cache(classroom_id)
 
         return jsonify(training_result), 200
     except ValueError as ve:
@@ -192,25 +189,20 @@ def recognize_faces_api(classroom_id):
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        img_bgr = decode_uploaded_image(file)
+        if img_bgr is None:
+            return jsonify({"error": "Could not decode the uploaded image"}), 400
 
         try:
             # Perform face recognition
-            recognition_results = recognize_faces_in_photo(filepath, classroom_id)
+            recognition_results = recognize_faces_in_photo(img_bgr, classroom_id, enhance=enhance_requested())
             if "image_url" in recognition_results:
                 recognition_results["resultImage"] = recognition_results.pop("image_url")
-            
-            # Remove the uploaded photo after processing
-            os.remove(filepath)
 
             return jsonify(recognition_results), 200
         except FileNotFoundError as fnf_e:
             return jsonify({"error": str(fnf_e), "status": "model_not_found"}), 404
         except Exception as e:
-            if os.path.exists(filepath):
-                os.remove(filepath)
             app.logger.error(f"Error during face recognition for {classroom_id}: {e}", exc_info=True)
             return jsonify({"error": f"Internal server error during recognition: {str(e)}"}), 500
     else:
@@ -226,7 +218,9 @@ def get_classroom_status(classroom_id):
     labeled_faces_dir = os.path.join(app.config['DATASETS_FOLDER'], classroom_id, "labeled_faces")
     labeled_faces_count = 0
     if os.path.exists(labeled_faces_dir):
-        labeled_faces_count = len([f for f in os.listdir(labeled_faces_dir) if f.lower().endswith(app.config['ALLOWED_EXTENSIONS'])])
+        with os.scandir(labeled_faces_dir) as entries:
+            labeled_faces_count = sum(1 for entry in entries
+                                      if entry.is_file() and allowed_file(entry.name))
 
     return jsonify({
         "classroom_id": classroom_id,
@@ -252,4 +246,6 @@ def serve_temp_face(classroom_id, filename):
 if __name__ == '__main__':
     # You can set USE_CUDA=true in your environment variables to enable GPU
     # Example: USE_CUDA=true python app.py
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # Set FLASK_DEBUG=true to enable the debugger and reloader
+    warmup_models()
+    app.run(debug=Config.DEBUG, threaded=True, host='0.0.0.0', port=5000)
\ No newline at end of file
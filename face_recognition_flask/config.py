@@ -1,6 +1,36 @@
 import os
+
+
+def _available_cpus():
+    """Number of CPUs this process can actually use, honouring affinity and the cgroup CPU quota."""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    # Containers often see every host CPU while being limited by a cgroup v2 quota
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+NUM_CPUS = _available_cpus()
+
+# Cap native thread pools to the CPU quota; must happen before numpy/torch are imported
+for _var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+    os.environ.setdefault(_var, str(NUM_CPUS))
+
+import cv2
 import torch
 
+cv2.setNumThreads(NUM_CPUS)
+cv2.ocl.setUseOpenCL(False)  # avoid OpenCL init cost on server
+
+# No cuDNN autotuning: MTCNN's input pyramid and candidate batch sizes and the recognition batch
+# size change with every photo, so benchmark mode would autotune on the request path
+torch.backends.cudnn.benchmark = False
+
 class Config:
     # Base directory for the Flask app
     BASE_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -25,10 +55,19 @@ class Config:
     os.makedirs(OUTPUT_IMAGES_FOLDER, exist_ok=True)
 
     # Allowed extensions for image uploads
-    ALLOWED_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+    ALLOWED_EXTENSIONS = frozenset(('.png', '.jpg', '.jpeg'))
 
     # Face recognition confidence threshold (can be adjusted)
     RECOGNITION_CONFIDENCE_THRESHOLD = 0.3
 
+    # Number of classroom models kept loaded in memory for recognition
+    MODEL_CACHE_SIZE = int(os.environ.get('MODEL_CACHE_SIZE', 4))
+
+    # Flask debugger/reloader; off unless FLASK_DEBUG=true (it adds per-request overhead and loads models twice)
+    DEBUG = os.environ.get('FLASK_DEBUG', 'false').lower() == 'true'
+
     # Device for PyTorch
-    DEVICE = 'cuda' if os.environ.get('USE_CUDA', 'false').lower() == 'true' and torch.cuda.is_available() else 'cpu'
\ No newline at end of file
+    DEVICE = 'cuda' if os.environ.get('USE_CUDA', 'false').lower() == 'true' and torch.cuda.is_available() else 'cpu'
+
+    # Run recognition through an FP16 TensorRT engine when on CUDA (falls back to PyTorch if unavailable)
+    USE_TENSORRT = os.environ.get('USE_TENSORRT', 'false').lower() == 'true'
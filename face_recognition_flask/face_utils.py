@@ -1,19 +1,42 @@
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 import cv2
 import torch
+import torch.nn.functional as F
 import numpy as np
 import pickle
+from numba import njit
 from PIL import Image
 from facenet_pytorch import MTCNN
-from torchvision import transforms
 from config import Config
 from models import EnhancedSiameseNetwork
+from trt_utils import load_trt_model
 import pandas as pd
 import matplotlib.pyplot as plt
 
 # Initialize global device
 DEVICE = Config.DEVICE
 
+# Background pool for JPEG encoding of face crops
+_SAVE_POOL = ThreadPoolExecutor(max_workers=4)
+
+# Slight sharpening kernel applied after contrast enhancement
+_SHARPEN_KERNEL = np.array([[0, -1, 0], [-1, 5, -1], [0, -1, 0]], dtype=np.float32)
+
+# Per-thread CLAHE objects for image preprocessing (request handlers run on several threads)
+_thread_local = threading.local()
+
+# Loaded (model, reference matrices) per classroom, most recently used last
+_MODEL_CACHE = OrderedDict()
+# In-flight loads keyed by (classroom_id, files_mtime), so concurrent requests share one load
+_MODEL_LOADS = {}
+_CACHE_LOCK = threading.Lock()
+
+# Recognition network and reference embeddings run in half precision on GPU to use Tensor Cores
+INFERENCE_DTYPE = torch.float16 if DEVICE == 'cuda' else torch.float32
+
 # Pre-load MTCNN detector for efficiency
 mtcnn_detector = MTCNN(
     keep_all=True,
@@ -24,19 +47,30 @@ mtcnn_detector = MTCNN(
     post_process=True
 )
 
-# Define the standard transformation for the Siamese Network input
-RECOGNITION_TRANSFORM = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
-])
+# Input size (width, height) of the Siamese Network
+RECOGNITION_INPUT_SIZE = (224, 224)
+# Largest recognition batch run in one forward; bigger batches (3 views per face) are chunked
+RECOGNITION_MAX_BATCH = 128
 
 
-def calculate_iou(box1, box2):
-    """Calculate Intersection over Union for two bounding boxes"""
-    box1 = [float(x) for x in box1]
-    box2 = [float(x) for x in box2]
+def warmup_models():
+    """Run dummy detection and embedding passes so CUDA context, cuDNN and kernel setup
+       happen at startup instead of on the first user request.
+    """
+    print("Warming up face detection and recognition models...")
+    mtcnn_detector.detect(Image.new('RGB', (1920, 1080)))
+
+    model = EnhancedSiameseNetwork().fuse_for_inference().to(DEVICE, dtype=INFERENCE_DTYPE, memory_format=torch.channels_last)
+    # One representative pass: the three views of a single face
+    dummy_input = torch.randn(3, 3, *RECOGNITION_INPUT_SIZE, device=DEVICE, dtype=INFERENCE_DTYPE)
+    with torch.inference_mode():
+        model(dummy_input.contiguous(memory_format=torch.channels_last))
+    print("Warm-up complete.")
+
 
+@njit('f4(f4[:], f4[:])', cache=True, fastmath=True)
+def _iou(box1, box2):
+    """Calculate Intersection over Union for two bounding boxes"""
     x_left = max(box1[0], box2[0])
     y_top = max(box1[1], box2[1])
     x_right = min(box1[2], box2[2])
@@ -51,7 +85,58 @@ def calculate_iou(box1, box2):
     box2_area = (box2[2] - box2[0]) * (box2[3] - box2[1])
     union_area = box1_area + box2_area - intersection_area
 
-    return intersection_area / union_area if union_area > 0 else 0
+    return intersection_area / union_area if union_area > 0 else 0.0
+
+
+@njit('b1[:](f4[:, :], f4[:, :], f4)', cache=True)
+def nms_filter(existing, candidates, iou_thresh):
+    """Return a mask of the candidate boxes that overlap neither an existing box
+       nor a previously accepted candidate.
+    """
+    is_new = np.ones(candidates.shape[0], dtype=np.bool_)
+    for i in range(candidates.shape[0]):
+        for j in range(existing.shape[0]):
+            if _iou(candidates[i], existing[j]) > iou_thresh:
+                is_new[i] = False
+                break
+        if not is_new[i]:
+            continue
+        for k in range(i):
+            if is_new[k] and _iou(candidates[i], candidates[k]) > iou_thresh:
+                is_new[i] = False
+                break
+    return is_new
+
+
+def merge_detections(boxes_orig, probs_orig, boxes_enhanced, probs_enhanced, min_prob, iou_threshold=0.5):
+    """Combine high-confidence detections from the original and enhanced images.
+       Enhanced detections overlapping an already accepted detection are treated as duplicates.
+       Returns an (N x 4) array of boxes.
+    """
+    all_boxes = np.empty((0, 4), dtype=np.float32)
+
+    # Collect high-confidence detections from original
+    if boxes_orig is not None:
+        all_boxes = np.asarray(boxes_orig, dtype=np.float32)[np.asarray(probs_orig, dtype=np.float32) > min_prob]
+
+    # Collect high-confidence detections from enhanced, avoiding duplicates
+    if boxes_enhanced is not None:
+        candidates = np.asarray(boxes_enhanced, dtype=np.float32)[np.asarray(probs_enhanced, dtype=np.float32) > min_prob]
+        if len(candidates):
+            # If significant overlap with an existing box, it's not a new face
+            candidates = candidates[nms_filter(all_boxes, candidates, iou_threshold)]
+        all_boxes = np.concatenate([all_boxes, candidates])
+
+    return all_boxes
+
+
+def _thread_clahe(name, tile_grid_size):
+    """Return a per-thread CLAHE instance (cv2.CLAHE keeps internal buffers and is not thread-safe)."""
+    clahe = getattr(_thread_local, name, None)
+    if clahe is None:
+        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=tile_grid_size)
+        setattr(_thread_local, name, clahe)
+    return clahe
 
 
 def preprocess_image_for_detection(image_np):
@@ -61,17 +146,14 @@ def preprocess_image_for_detection(image_np):
     if image_np is None:
         return None
 
-    # Apply adaptive histogram equalization to improve contrast
+    # Apply adaptive histogram equalization to improve contrast (L channel of LAB)
     lab = cv2.cvtColor(image_np, cv2.COLOR_RGB2LAB)
-    l, a, b = cv2.split(lab)
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    cl = clahe.apply(l)
-    enhanced_lab = cv2.merge((cl, a, b))
-    enhanced_img = cv2.cvtColor(enhanced_lab, cv2.COLOR_LAB2RGB)
+    l_channel = cv2.extractChannel(lab, 0)
+    cv2.insertChannel(_thread_clahe('clahe_detection', (8, 8)).apply(l_channel), lab, 0)
 
-    # Apply slight sharpening
-    kernel = np.array([[0, -1, 0], [-1, 5, -1], [0, -1, 0]])
-    sharpened_img = cv2.filter2D(enhanced_img, -1, kernel)
+    # Convert back and apply slight sharpening, both into the same output array
+    sharpened_img = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
+    cv2.filter2D(sharpened_img, -1, _SHARPEN_KERNEL, dst=sharpened_img)
 
     return sharpened_img
 
@@ -88,70 +170,91 @@ def enhance_face_crop(face_img_np):
     l, a, b = cv2.split(face_lab)
 
     # Apply CLAHE to L channel
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(4, 4))
-    cl = clahe.apply(l)
+    cl = _thread_clahe('clahe_face', (4, 4)).apply(l)
 
     # Merge back
     enhanced_lab = cv2.merge((cl, a, b))
     enhanced_face = cv2.cvtColor(enhanced_lab, cv2.COLOR_LAB2RGB)
 
-    # Apply mild denoising
-    enhanced_face = cv2.fastNlMeansDenoisingColored(enhanced_face, None, 5, 5, 7, 21)
+    # Apply mild edge-preserving denoising (much cheaper than non-local means)
+    enhanced_face = cv2.bilateralFilter(enhanced_face, 5, 50, 50)
 
     return enhanced_face
 
 
-def detect_and_crop_faces(image_path, classroom_id):
+def detect_face_boxes(rgb_image, min_prob, enhance=False):
     """
-    Detects and crops faces from a group photo using MTCNN.
-    Saves temporary face images for a specific classroom and returns their data.
+    Runs MTCNN on an RGB image and returns an (N x 4) array of confident face boxes.
+    With `enhance`, the original and a CLAHE/sharpened copy are detected in one batched
+    pass and merged; this is slower and only worth it for difficult images.
     """
-    print(f"Detecting faces in {image_path} for classroom {classroom_id}...")
-
-    img = cv2.imread(image_path)
-    if img is None:
-        raise FileNotFoundError(f"Image not found at {image_path}")
-
-    rgb_image = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
     pil_image = Image.fromarray(rgb_image)
+    if not enhance:
+        boxes, probs = mtcnn_detector.detect(pil_image)
+        return merge_detections(boxes, probs, None, None, min_prob=min_prob)
 
     # Preprocess image for better detection
     enhanced_img_np = preprocess_image_for_detection(rgb_image)
-    enhanced_pil_image = Image.fromarray(enhanced_img_np) if enhanced_img_np is not None else pil_image
+    enhanced_pil_image = Image.fromarray(enhanced_img_np)
 
-    # Detect faces on both original and enhanced images, then combine/filter
-    boxes_orig, probs_orig = mtcnn_detector.detect(pil_image)
-    boxes_enhanced, probs_enhanced = mtcnn_detector.detect(enhanced_pil_image)
+    # Detect faces on both original and enhanced images in a single batched pass (same size), then combine/filter
+    boxes_list, probs_list = mtcnn_detector.detect([pil_image, enhanced_pil_image])
+    boxes_orig, boxes_enhanced = boxes_list
+    probs_orig, probs_enhanced = probs_list
 
-    all_boxes = []
-    all_probs = []
+    return merge_detections(boxes_orig, probs_orig, boxes_enhanced, probs_enhanced, min_prob=min_prob)
 
-    # Collect high-confidence detections from original
-    if boxes_orig is not None:
-        for box, prob in zip(boxes_orig, probs_orig):
-            if prob > 0.95: # High confidence
-                all_boxes.append(box)
-                all_probs.append(prob)
 
-    # Collect high-confidence detections from enhanced, avoiding duplicates
-    if boxes_enhanced is not None:
-        for box, prob in zip(boxes_enhanced, probs_enhanced):
-            if prob > 0.95:
-                is_new = True
-                for existing_box in all_boxes:
-                    iou = calculate_iou(box, existing_box)
-                    if iou > 0.5: # If significant overlap, it's not a new face
-                        is_new = False
-                        break
-                if is_new:
-                    all_boxes.append(box)
-                    all_probs.append(prob)
-
-    if not all_boxes:
+def faces_to_tensor(face_crops):
+    """
+    Resizes RGB face crops (NumPy arrays) to the network input size and uploads them as one
+    normalized NCHW batch on DEVICE, equivalent to Resize + ToTensor + Normalize(0.5, 0.5).
+    """
+    resized = []
+    for crop in face_crops:
+        # Area interpolation when shrinking avoids aliasing, like PIL's antialiased resize
+        shrinking = crop.shape[1] > RECOGNITION_INPUT_SIZE[0] or crop.shape[0] > RECOGNITION_INPUT_SIZE[1]
+        interpolation = cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR
+        resized.append(cv2.resize(crop, RECOGNITION_INPUT_SIZE, interpolation=interpolation))
+
+    # NHWC uint8 -> NCHW view (channels_last strides), then scale to [-1, 1] on the device
+    batch = torch.from_numpy(np.stack(resized)).to(DEVICE, non_blocking=True).permute(0, 3, 1, 2)
+    return batch.to(INFERENCE_DTYPE).div_(127.5).sub_(1.0)
+
+
+def save_rgb_jpeg(path, rgb_image):
+    """Encode an RGB image as JPEG on disk (cv2 releases the GIL, so this runs well on _SAVE_POOL)."""
+    cv2.imwrite(path, cv2.cvtColor(rgb_image, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, 85])
+
+
+def load_bgr_image(image):
+    """Return a BGR image array from either a file path or an already decoded array."""
+    if isinstance(image, np.ndarray):
+        return image
+    img = cv2.imread(image)
+    if img is None:
+        raise FileNotFoundError(f"Image not found at {image}")
+    return img
+
+
+def detect_and_crop_faces(image, classroom_id, enhance=False):
+    """
+    Detects and crops faces from a group photo using MTCNN.
+    `image` is a BGR NumPy array (or a path to an image file); `enhance` also
+    detects on a contrast-enhanced copy, for difficult photos.
+    Saves temporary face images for a specific classroom and returns their data.
+    """
+    print(f"Detecting faces for classroom {classroom_id}...")
+
+    img = load_bgr_image(image)
+    rgb_image = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    all_boxes = detect_face_boxes(rgb_image, min_prob=0.95, enhance=enhance)
+
+    if len(all_boxes) == 0:
         print("No faces detected in the group photo with sufficient confidence.")
         return []
 
-    all_boxes = np.array(all_boxes)
     print(f"Detected {len(all_boxes)} unique faces.")
 
     face_data = [] # Data about detected faces (temp_id, bbox, path)
@@ -160,7 +263,8 @@ def detect_and_crop_faces(image_path, classroom_id):
     temp_face_output_dir = os.path.join(Config.DATASETS_FOLDER, classroom_id, "temp_faces")
     os.makedirs(temp_face_output_dir, exist_ok=True)
 
-    # Assign temporary IDs and save faces
+    # Assign temporary IDs and save faces (JPEG encoding runs on the save pool)
+    save_futures = []
     for i, box in enumerate(all_boxes):
         x1, y1, x2, y2 = map(int, box)
 
@@ -177,109 +281,177 @@ def detect_and_crop_faces(image_path, classroom_id):
         if face_crop_np.size == 0: # Skip empty crops
             continue
 
-        face_pil = Image.fromarray(face_crop_np)
-
         # Create a unique temporary ID for each face
         temp_face_id = f"temp_{i:03d}"
         face_path = os.path.join(temp_face_output_dir, f"{temp_face_id}.jpg")
-        face_pil.save(face_path)
+        save_futures.append(_SAVE_POOL.submit(save_rgb_jpeg, face_path, face_crop_np))
 
         face_data.append({
             "face_id": temp_face_id,
             "image_path": face_path,
             "bbox": [int(x1), int(y1), int(x2), int(y2)] # Original non-padded bbox
         })
-    
+
+    # Faces must be on disk before roll numbers can be assigned to them
+    for future in save_futures:
+        future.result()
+
     print(f"Temporary detected faces saved to {temp_face_output_dir}")
     return face_data
 
 
 def load_face_recognition_model(classroom_id):
-    """Load the trained model and embeddings for a specific classroom."""
+    """Load the trained model and embeddings for a specific classroom, cached in-process."""
     model_path = os.path.join(Config.MODELS_FOLDER, classroom_id, 'siamese_model_best.pth')
+    refs_path = os.path.join(Config.EMBEDDINGS_FOLDER, classroom_id, 'refs.npz')
     embedding_dict_path = os.path.join(Config.EMBEDDINGS_FOLDER, classroom_id, 'embedding_dict.pkl')
     label_embeddings_path = os.path.join(Config.EMBEDDINGS_FOLDER, classroom_id, 'label_embeddings.pkl')
 
     if not os.path.exists(model_path):
         raise FileNotFoundError(f"Model file not found for classroom '{classroom_id}' at: {model_path}")
-    if not os.path.exists(embedding_dict_path):
-        raise FileNotFoundError(f"Embedding dictionary not found for classroom '{classroom_id}' at: {embedding_dict_path}")
-    if not os.path.exists(label_embeddings_path):
-        raise FileNotFoundError(f"Label embeddings not found for classroom '{classroom_id}' at: {label_embeddings_path}")
-
+    if os.path.exists(refs_path):
+        embedding_paths = (refs_path,)
+    else:
+        # Classrooms trained before refs.npz was introduced only have the pickled dictionaries
+        if not os.path.exists(embedding_dict_path):
+            raise FileNotFoundError(f"Embedding dictionary not found for classroom '{classroom_id}' at: {embedding_dict_path}")
+        if not os.path.exists(label_embeddings_path):
+            raise FileNotFoundError(f"Label embeddings not found for classroom '{classroom_id}' at: {label_embeddings_path}")
+        embedding_paths = (embedding_dict_path, label_embeddings_path)
+
+    # Reuse the resident model unless its files changed on disk (e.g. after retraining)
+    files_mtime = max(os.path.getmtime(path) for path in (model_path, *embedding_paths))
+    load_key = (classroom_id, files_mtime)
+    with _CACHE_LOCK:
+        cached = _MODEL_CACHE.get(classroom_id)
+        if cached is not None and cached[0] == files_mtime:
+            _MODEL_CACHE.move_to_end(classroom_id)
+            return cached[1]
+        pending = _MODEL_LOADS.get(load_key)
+        if pending is None:
+            _MODEL_LOADS[load_key] = Future()
+
+    # Another request is already loading this classroom; wait for its result
+    if pending is not None:
+        return pending.result()
+
+    # Load outside the lock: torch.load and TensorRT engine builds must not block other classrooms
+    future = _MODEL_LOADS[load_key]
+    try:
+        loaded = _load_model_and_references(classroom_id, model_path, refs_path, embedding_dict_path, label_embeddings_path)
+    except BaseException as e:
+        with _CACHE_LOCK:
+            _MODEL_LOADS.pop(load_key, None)
+        future.set_exception(e)
+        raise
+
+    with _CACHE_LOCK:
+        _MODEL_LOADS.pop(load_key, None)
+        cached = _MODEL_CACHE.get(classroom_id)
+        # Don't replace a model loaded from newer files while this one was loading
+        if cached is None or cached[0] <= files_mtime:
+            _MODEL_CACHE[classroom_id] = (files_mtime, loaded)
+            _MODEL_CACHE.move_to_end(classroom_id)
+            # Evict the least recently used classrooms to bound GPU memory
+            while len(_MODEL_CACHE) > Config.MODEL_CACHE_SIZE:
+                _MODEL_CACHE.popitem(last=False)
+    future.set_result(loaded)
+    return loaded
+
+
+def invalidate_model_cache(classroom_id):
+    """Drop the cached model and embeddings for a classroom so the next request reloads them."""
+    with _CACHE_LOCK:
+        _MODEL_CACHE.pop(classroom_id, None)
+
+
+def _load_model_and_references(classroom_id, model_path, refs_path, embedding_dict_path, label_embeddings_path):
+    """Load the model and reference embedding matrices for a classroom from disk."""
     # Load the model
     print(f"Loading trained model for classroom {classroom_id}...")
     model = EnhancedSiameseNetwork().to(DEVICE)
     model.load_state_dict(torch.load(model_path, map_location=DEVICE))
-    model.eval()
+    model.fuse_for_inference()
+
+    trt_model = None
+    if DEVICE == 'cuda' and Config.USE_TENSORRT:
+        trt_model = load_trt_model(model, model_path)
+
+    if trt_model is not None:
+        model = trt_model
+    else:
+        # NHWC lets cuDNN pick Tensor-Core-friendly convolution kernels
+        model = model.to(dtype=INFERENCE_DTYPE, memory_format=torch.channels_last)
 
     # Load embeddings
     print(f"Loading face embeddings for classroom {classroom_id}...")
+    labels, avg_ref, max_ref, max_boundaries = load_reference_matrices(refs_path, embedding_dict_path, label_embeddings_path)
+
+    # Keep the reference matrices resident on DEVICE; max_label_idx maps each row of max_ref to its label
+    avg_ref = torch.from_numpy(avg_ref).to(DEVICE, dtype=INFERENCE_DTYPE)
+    max_ref = torch.from_numpy(max_ref).to(DEVICE, dtype=INFERENCE_DTYPE)
+    label_counts = np.diff(max_boundaries, prepend=0)
+    max_label_idx = torch.from_numpy(np.repeat(np.arange(len(labels)), label_counts)).to(DEVICE)
+
+    return model, labels, avg_ref, max_ref, max_label_idx
+
+
+def load_reference_matrices(refs_path, embedding_dict_path, label_embeddings_path):
+    """
+    Load the stacked reference embeddings saved by training in `refs.npz`,
+    falling back to the legacy pickled embedding dictionaries.
+    """
+    if os.path.exists(refs_path):
+        with np.load(refs_path, allow_pickle=False) as data:
+            return data['labels'].tolist(), data['avg_ref'], data['max_ref'], data['boundaries']
+
     with open(embedding_dict_path, 'rb') as f:
         embedding_dict = pickle.load(f)
 
     with open(label_embeddings_path, 'rb') as f:
         label_embeddings = pickle.load(f)
 
-    return model, embedding_dict, label_embeddings
+    return build_reference_matrices(embedding_dict, label_embeddings)
+
+
+def build_reference_matrices(embedding_dict, label_embeddings):
+    """
+    Stacks the per-label reference embeddings into matrices so that similarity
+    search becomes a single matrix product.
+    Returns `labels`, `avg_ref` (L x D), `max_ref` (sum(k_i) x D) and `max_boundaries`,
+    the cumulative row count of each label's block in `max_ref`.
+    """
+    labels = [label for label in embedding_dict if len(label_embeddings.get(label, [])) > 0]
+    avg_ref = np.stack([embedding_dict[label] for label in labels]).astype(np.float32)
+    max_ref = np.concatenate([np.stack(label_embeddings[label]) for label in labels]).astype(np.float32)
+    max_boundaries = np.cumsum([len(label_embeddings[label]) for label in labels])
+    return labels, avg_ref, max_ref, max_boundaries
 
 
-def recognize_faces_in_photo(image_path, classroom_id):
+def recognize_faces_in_photo(image, classroom_id, enhance=False):
     """
     Performs face detection and recognition on a given photo using a trained model
-    for a specific classroom.
+    for a specific classroom. `image` is a BGR NumPy array (or a path to an image file);
+    `enhance` also detects on a contrast-enhanced copy, for difficult photos.
     """
-    print(f"\nPerforming face recognition on: {image_path} for classroom: {classroom_id}")
+    print(f"\nPerforming face recognition for classroom: {classroom_id}")
 
     try:
-        model, embedding_dict, label_embeddings = load_face_recognition_model(classroom_id)
+        model, labels, avg_ref, max_ref, max_label_idx = load_face_recognition_model(classroom_id)
     except FileNotFoundError as e:
         print(f"Error: {e}")
         return {"error": str(e), "status": "model_not_found"}
 
     # Load the original image for drawing
-    image = cv2.imread(image_path)
-    if image is None:
-        raise FileNotFoundError(f"Image not found at {image_path}")
+    image = load_bgr_image(image)
     rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
-    # Preprocess the image for detection
-    enhanced_img_np = preprocess_image_for_detection(rgb_image)
-    
-    pil_image = Image.fromarray(rgb_image)
-    enhanced_pil = Image.fromarray(enhanced_img_np) if enhanced_img_np is not None else pil_image
-
-    # Detect faces using both original and preprocessed images
-    boxes_orig, probs_orig = mtcnn_detector.detect(pil_image)
-    boxes_enhanced, probs_enhanced = mtcnn_detector.detect(enhanced_pil)
-
-    all_boxes = []
-    all_probs = []
-
-    if boxes_orig is not None:
-        for box, prob in zip(boxes_orig, probs_orig):
-            if prob > 0.97:  # High confidence threshold
-                all_boxes.append(box)
-                all_probs.append(prob)
+    all_boxes = detect_face_boxes(rgb_image, min_prob=0.97, enhance=enhance)
 
-    if boxes_enhanced is not None:
-        for box, prob in zip(boxes_enhanced, probs_enhanced):
-            if prob > 0.97:
-                is_new = True
-                for existing_box in all_boxes:
-                    iou = calculate_iou(box, existing_box)
-                    if iou > 0.5:  # If significant overlap
-                        is_new = False
-                        break
-                if is_new:
-                    all_boxes.append(box)
-                    all_probs.append(prob)
-
-    if not all_boxes:
+    if len(all_boxes) == 0:
         print("No faces detected with sufficient confidence for recognition.")
         return {"recognized_faces": [], "image_url": None, "message": "No faces detected."}
 
-    all_boxes = np.array(all_boxes)
     print(f"Detected {len(all_boxes)} faces in the image for recognition.")
 
     recognized_faces_data = []
@@ -287,8 +459,11 @@ def recognize_faces_in_photo(image_path, classroom_id):
     # Prepare image for drawing bounding boxes and labels
     img_with_boxes = image.copy() # Use a copy to draw on
 
-    # Process each detected face
-    for i, box in enumerate(all_boxes):
+    # Crop and enhance each detected face
+    face_boxes = []
+    face_crops = []
+    face_enhanced_nps = []
+    for box in all_boxes:
         x1, y1, x2, y2 = map(int, box)
 
         # Dynamic padding to face crop
@@ -305,70 +480,65 @@ def recognize_faces_in_photo(image_path, classroom_id):
         if face_crop_np.size == 0:
             continue
 
-        face_pil = Image.fromarray(face_crop_np)
-
         # Enhance face quality
         face_enhanced_np = enhance_face_crop(face_crop_np)
-        face_pil_enhanced = Image.fromarray(face_enhanced_np)
-
-        # Generate multiple embeddings for robust recognition
-        embeddings = []
-        with torch.no_grad():
-            # Original face
-            img_tensor = RECOGNITION_TRANSFORM(face_pil).unsqueeze(0).to(DEVICE)
-            embeddings.append(model(img_tensor).squeeze().cpu().numpy())
-
-            # Enhanced face
-            img_tensor_enhanced = RECOGNITION_TRANSFORM(face_pil_enhanced).unsqueeze(0).to(DEVICE)
-            embeddings.append(model(img_tensor_enhanced).squeeze().cpu().numpy())
-
-            # Horizontally flipped face
-            flipped_face_pil = transforms.functional.hflip(face_pil)
-            img_tensor_flipped = RECOGNITION_TRANSFORM(flipped_face_pil).unsqueeze(0).to(DEVICE)
-            embeddings.append(model(img_tensor_flipped).squeeze().cpu().numpy())
-
-        # Average the embeddings for the current detected face
-        face_embedding = np.mean(embeddings, axis=0)
-        face_embedding = face_embedding / np.linalg.norm(face_embedding)  # Normalize
-
-        # Ensemble method for recognition
-        results = []
-
-        # Method 1: Compare with average embeddings
-        for label, ref_embedding in embedding_dict.items():
-            similarity = np.dot(face_embedding, ref_embedding)
-            results.append((label, similarity, "avg"))
-
-        # Method 2: Compare with each individual embedding and take maximum
-        for label, ref_embeddings_list in label_embeddings.items():
-            if ref_embeddings_list:
-                similarities = [np.dot(face_embedding, ref_emb) for ref_emb in ref_embeddings_list]
-                max_similarity = max(similarities)
-                results.append((label, max_similarity, "max"))
-
-        # Sort by similarity score
-        results.sort(key=lambda x: x[1], reverse=True)
-
-        # Get top matches from both methods
-        avg_matches = [r for r in results if r[2] == "avg"][:3]
-        max_matches = [r for r in results if r[2] == "max"][:3]
-
-        # Weighted ensemble of both methods
-        final_scores = {}
-        for label, score, method in avg_matches + max_matches:
-            if label not in final_scores:
-                final_scores[label] = 0
-            # Weight the "avg" method slightly higher
-            weight = 1.2 if method == "avg" else 1.0
-            final_scores[label] += score * weight
-
-        # Get the highest scoring label
-        if final_scores:
-            most_similar_face, highest_score = max(final_scores.items(), key=lambda x: x[1])
-            highest_score_normalized = highest_score / (1.2 * len(avg_matches) + 1.0 * len(max_matches))
-            highest_score_normalized = min(highest_score_normalized, 1.0)
-        else:
-            most_similar_face, highest_score_normalized = None, 0
+
+        face_boxes.append((x1, y1, x2, y2))
+        face_crops.append(face_crop_np)
+        face_enhanced_nps.append(face_enhanced_np)
+
+    if not face_boxes:
+        print("No valid face crops for recognition.")
+        return {"recognized_faces": [], "image_url": None, "message": "No faces detected."}
+
+    # Generate multiple embeddings (original, enhanced, flipped) for every face in one batched forward pass
+    num_faces = len(face_crops)
+    orig_batch = faces_to_tensor(face_crops)
+    enh_batch = faces_to_tensor(face_enhanced_nps)
+    batch = torch.cat([orig_batch, enh_batch, orig_batch.flip(3)])
+
+    with torch.inference_mode():
+        embeddings = torch.cat([model(chunk.contiguous(memory_format=torch.channels_last))
+                                for chunk in batch.split(RECOGNITION_MAX_BATCH)])
+
+    # Average the three embeddings of each face and re-normalize
+    face_embeddings = embeddings.reshape(3, num_faces, -1).mean(dim=0)
+    face_embeddings = F.normalize(face_embeddings, p=2, dim=1).to(INFERENCE_DTYPE)
+
+    # Ensemble method for recognition, vectorized over all faces and labels on DEVICE
+    # Method 1: Compare with average embeddings
+    avg_sims = (face_embeddings @ avg_ref.T).float()
+    # Method 2: Compare with each individual embedding and take maximum per label
+    max_flat = (face_embeddings @ max_ref.T).float()
+    max_sims = torch.full_like(avg_sims, float('-inf')).scatter_reduce_(
+        1, max_label_idx.expand(num_faces, -1), max_flat, reduce='amax')
+
+    # Get top matches from both methods
+    top_k = min(3, len(labels))
+    avg_top_scores, avg_top = avg_sims.topk(top_k, dim=1)
+    max_top_scores, max_top = max_sims.topk(top_k, dim=1)
+
+    # Weighted ensemble of both methods, weighting the "avg" method slightly higher
+    final_scores = torch.zeros_like(avg_sims)
+    final_scores.scatter_add_(1, avg_top, 1.2 * avg_top_scores)
+    final_scores.scatter_add_(1, max_top, 1.0 * max_top_scores)
+    selected = torch.zeros_like(avg_sims, dtype=torch.bool)
+    selected.scatter_(1, avg_top, True)
+    selected.scatter_(1, max_top, True)
+    final_scores.masked_fill_(~selected, float('-inf'))
+
+    # Get the highest scoring label per face; only these leave the device
+    best_scores, best_label_idx = final_scores.max(dim=1)
+    best_scores = (best_scores / (1.2 * top_k + 1.0 * top_k)).clamp(max=1.0)
+    best_scores = best_scores.cpu().tolist()
+    best_label_idx = best_label_idx.cpu().tolist()
+
+    # Process each detected face
+    save_futures = []
+    for i, (x1, y1, x2, y2) in enumerate(face_boxes):
+        face_enhanced_np = face_enhanced_nps[i]
+        most_similar_face = labels[best_label_idx[i]]
+        highest_score_normalized = best_scores[i]
 
         roll_number = "Unknown"
         confidence = "Low"
@@ -392,7 +562,7 @@ def recognize_faces_in_photo(image_path, classroom_id):
 
         # Save the detected face crop
         face_filename = os.path.join(Config.RECOGNIZED_FACES_FOLDER, f"face_{classroom_id}_{roll_number}_{i}.jpg")
-        Image.fromarray(cv2.cvtColor(face_enhanced_np, cv2.COLOR_RGB2BGR)).save(face_filename)
+        save_futures.append(_SAVE_POOL.submit(save_rgb_jpeg, face_filename, face_enhanced_np))
 
         recognized_faces_data.append({
             "bbox": [x1, y1, x2, y2],
@@ -405,6 +575,8 @@ def recognize_faces_in_photo(image_path, classroom_id):
     timestamp = pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')
     result_filename = os.path.join(Config.OUTPUT_IMAGES_FOLDER, f"recognition_result_{classroom_id}_{timestamp}.jpg")
     cv2.imwrite(result_filename, img_with_boxes)
+    for future in save_futures:
+        future.result()
     print(f"Annotated image saved as '{result_filename}'")
     
     image_url = f"/output_images/{os.path.basename(result_filename)}"
@@ -3,53 +3,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 from facenet_pytorch import InceptionResnetV1
 
-class SelfAttention(nn.Module):
-    def __init__(self, embed_size, heads):
-        super(SelfAttention, self).__init__()
-        self.embed_size = embed_size
-        self.heads = heads
-        self.head_dim = embed_size // heads
-
-        assert (
-            self.head_dim * heads == embed_size
-        ), "Embed size needs to be divisible by heads"
-
-        self.values = nn.Linear(self.head_dim, self.head_dim, bias=False)
-        self.keys = nn.Linear(self.head_dim, self.head_dim, bias=False)
-        self.queries = nn.Linear(self.head_dim, self.head_dim, bias=False)
-        self.fc_out = nn.Linear(heads * self.head_dim, embed_size)
-
-    def forward(self, values, keys, query):
-        N = query.shape[0]
-        value_len, key_len, query_len = values.shape[1], keys.shape[1], query.shape[1]
-
-        # Split the embedding into self.heads pieces
-        values = values.reshape(N, value_len, self.heads, self.head_dim)
-        keys = keys.reshape(N, key_len, self.heads, self.head_dim)
-        queries = query.reshape(N, query_len, self.heads, self.head_dim)
-
-        values = self.values(values)
-        keys = self.keys(keys)
-        queries = self.queries(queries)
-
-        # Einsum does matrix multiplication for query * key.T
-        # sum over last two dimensions (head_dim)
-        attention = torch.einsum("nqhd,nkhd->nhqk", [queries, keys])
-        # queries: (N, query_len, heads, head_dim)
-        # keys: (N, key_len, heads, head_dim)
-        # attention: (N, heads, query_len, key_len)
-
-        attention_weights = F.softmax(attention / (self.embed_size ** (1 / 2)), dim=3)
-
-        out = torch.einsum("nhql,nlhd->nqhd", [attention_weights, values]).reshape(
-            N, query_len, self.heads * self.head_dim
-        )
-        # attention_weights: (N, heads, query_len, key_len)
-        # values: (N, value_len, heads, head_dim)
-        # out: (N, query_len, heads * head_dim)
-
-        out = self.fc_out(out)
-        return out
+# InceptionResnetV1 stages before the first one with trainable parameters (block8); all frozen
+BACKBONE_STEM = ('conv2d_1a', 'conv2d_2a', 'conv2d_2b', 'maxpool_3a', 'conv2d_3b', 'conv2d_4a', 'conv2d_4b',
+                 'repeat_1', 'mixed_6a', 'repeat_2', 'mixed_7a', 'repeat_3')
 
 
 class EnhancedSiameseNetwork(nn.Module):
@@ -65,7 +21,8 @@ class EnhancedSiameseNetwork(nn.Module):
         # Enhanced feature extraction and embedding layers
         self.conv1 = nn.Conv2d(512, 512, kernel_size=1, stride=1, padding=0)
         self.bn1 = nn.BatchNorm2d(512)
-        self.attention = SelfAttention(512, heads=8) # Added heads argument
+        # Native multi-head attention: packed bias-free QKV projection and the fused SDPA kernel
+        self.attention = nn.MultiheadAttention(512, 8, batch_first=True, bias=False)
 
         # Fully connected layers for embedding
         self.fc1 = nn.Linear(512, 512)
@@ -77,9 +34,52 @@ class EnhancedSiameseNetwork(nn.Module):
         self.dropout = nn.Dropout(p=0.3)
         self.relu = nn.ReLU()
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # self.attention is never called in forward, so weights from the old hand-rolled SelfAttention
+        # are dropped and the module keeps its current parameters
+        attn = f"{prefix}attention."
+        legacy_keys = [key for key in state_dict if key.startswith(attn)
+                       and key[len(attn):].split('.')[0] in ('queries', 'keys', 'values', 'qkv', 'fc_out')]
+        if legacy_keys:
+            for key in legacy_keys:
+                del state_dict[key]
+            for name, tensor in self.attention.state_dict().items():
+                state_dict.setdefault(f"{attn}{name}", tensor)
+        super(EnhancedSiameseNetwork, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        """
+        Folds the eval-mode batch_norm into fc2 and removes dropout; only for inference.
+        batch_norm follows the ReLU, so it is an affine map on fc2's input: fc2(a*x + c) = (W*a) x + (W c + b).
+        """
+        bn = self.batch_norm
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias - bn.running_mean * scale
+        self.fc2.bias.add_(self.fc2.weight @ shift)
+        self.fc2.weight.mul_(scale)
+        self.batch_norm = nn.Identity()
+        self.dropout = nn.Identity()
+        return self.eval()
+
+    def extract_features(self, x):
+        """InceptionResnetV1 forward, with the frozen stem kept out of the autograd graph."""
+        base = self.base_model
+        # No activations are stored or graph built for the frozen stem, even during training
+        with torch.no_grad():
+            for name in BACKBONE_STEM:
+                x = getattr(base, name)(x)
+
+        x = base.block8(x)
+        x = base.avgpool_1a(x)
+        x = base.dropout(x)
+        x = base.last_linear(x.view(x.shape[0], -1))
+        x = base.last_bn(x)
+        return F.normalize(x, p=2, dim=1)
+
     def forward(self, x):
         # Get features from base model
-        x = self.base_model(x) # Output of InceptionResnetV1 is typically 512-dim embedding
+        x = self.extract_features(x) # Output of InceptionResnetV1 is typically 512-dim embedding
 
         # Additional processing layers as per your snippet
         x = self.fc1(x)
@@ -16,6 +16,8 @@ def run_flask_app():
     """Run the Flask application"""
     try:
         from app import app
+        from config import Config
+        from face_utils import warmup_models
         print("Starting Flask Face Recognition API...")
         print("Available endpoints:")
         print("  POST /classroom/<id>/detect_faces - Detect faces in group photo")
@@ -24,7 +26,8 @@ def run_flask_app():
         print("  POST /classroom/<id>/recognize_faces - Take attendance")
         print("  GET  /classroom/<id>/status - Get classroom status")
         
-        app.run(host='0.0.0.0', port=8000, debug=True)
+        warmup_models()
+        app.run(host='0.0.0.0', port=8000, debug=Config.DEBUG, threaded=True)
     except ImportError as e:
         print(f"Import error: {e}")
         print("Please install the required packages first.")
@@ -1,169 +1,247 @@
 import os
+import math
+from contextlib import contextmanager
 import torch
 import numpy as np
-import pickle
-import pandas as pd
 from PIL import Image
 from torchvision import transforms
 from tqdm import tqdm
-import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader, Sampler
 
-from config import Config
+from config import Config, NUM_CPUS
 from models import EnhancedSiameseNetwork
 
 # Device global variable from Config
 DEVICE = Config.DEVICE
 
-# Dataset class for Siamese Network training
+# bf16 autocast needs no GradScaler, so mixed precision training is enabled only where the GPU supports it
+USE_BF16 = DEVICE == 'cuda' and torch.cuda.is_bf16_supported()
+AMP_DTYPE = torch.bfloat16 if USE_BF16 else torch.float16
+
+# Margin for the triplet loss; adjusted for potentially better separation
+TRIPLET_MARGIN = 0.8
+# Samples drawn per identity in each P x K training batch
+SAMPLES_PER_LABEL = 4
+# Augmented views per labeled face; sizes a training epoch and the extra reference embeddings
+AUGMENTED_VIEWS_PER_FACE = 5
+
+# Side length faces are stored at and fed to the model
+IMAGE_SIZE = 224
+# Batch size for the reference embedding pass
+EMBEDDING_BATCH_SIZE = 64
+# torch.compile only pays for its compile time on training runs with at least this many optimizer steps
+COMPILE_MIN_STEPS = 500
+
+# Dataset class for Siamese Network training: single images with integer labels, triplets are mined per batch
 class SiameseDataset(Dataset):
-    def __init__(self, df, transform=None):
-        self.df = df
-        self.labels = df['label'].unique()
+    """
+    Decodes every face once into a shared-memory uint8 tensor (N x 3 x 224 x 224), so training steps
+    and DataLoader workers index into it instead of re-reading and re-decoding JPEGs.
+    `transform` is applied to the uint8 CHW tensor.
+    """
+    def __init__(self, records, transform=None):
+        paths = [record['image_path'] for record in records]
+        self.labels, self.label_ids = np.unique([record['label'] for record in records], return_inverse=True)
         self.transform = transform
-        self.label_to_paths = {label: list(df[df['label'] == label]['image_path']) for label in self.labels}
+
+        self.images = torch.empty((len(paths), 3, IMAGE_SIZE, IMAGE_SIZE), dtype=torch.uint8).share_memory_()
+        for i, path in enumerate(tqdm(paths, desc="Decoding faces")):
+            img = Image.open(path).convert('RGB').resize((IMAGE_SIZE, IMAGE_SIZE), Image.BILINEAR)
+            self.images[i] = torch.from_numpy(np.asarray(img)).permute(2, 0, 1)
 
     def __len__(self):
-        return len(self.df)
+        return len(self.images)
 
     def __getitem__(self, idx):
-        anchor_path = self.df.iloc[idx]['image_path']
-        anchor_label = self.df.iloc[idx]['label']
+        img = self.images[idx]
+        if self.transform:
+            img = self.transform(img)
+        return img, self.label_ids[idx]
 
-        # Get positive sample (same label)
-        positive_paths = [p for p in self.label_to_paths[anchor_label] if p != anchor_path]
-        if not positive_paths: # Handle case with only one image for a label
-            positive_path = anchor_path # Use anchor as positive if no other available
-        else:
-            positive_path = np.random.choice(positive_paths)
 
-        # Get negative sample (different label)
-        negative_label = np.random.choice([l for l in self.labels if l != anchor_label])
-        negative_path = np.random.choice(self.label_to_paths[negative_label])
+class BalancedBatchSampler(Sampler):
+    """
+    Yields P x K batches of dataset indices: P distinct labels with K images each, so every anchor
+    has positives and negatives in its batch. Labels with fewer than K images are sampled with replacement.
+    An epoch covers `views_per_image` augmented views of every image and visits every label at least once.
+    """
+    def __init__(self, label_ids, batch_size, samples_per_label=SAMPLES_PER_LABEL, views_per_image=1):
+        # Dataset indices grouped per label, built once with a single sort instead of a scan per label
+        order = np.argsort(label_ids, kind='stable')
+        self.label_to_indices = np.split(order, np.cumsum(np.bincount(label_ids))[:-1])
+        self.samples_per_label = samples_per_label
+        self.labels_per_batch = min(len(self.label_to_indices), max(2, batch_size // samples_per_label))
+        self.num_batches = max(math.ceil(len(label_ids) * views_per_image / batch_size),
+                               math.ceil(len(self.label_to_indices) / self.labels_per_batch))
 
-        # Load images
-        anchor_img = Image.open(anchor_path).convert('RGB')
-        positive_img = Image.open(positive_path).convert('RGB')
-        negative_img = Image.open(negative_path).convert('RGB')
+    def __len__(self):
+        return self.num_batches
+
+    def _epoch_labels(self):
+        """Labels for each batch: a shuffled pass over all labels, topped up with other labels as needed."""
+        num_labels = len(self.label_to_indices)
+        unvisited = np.random.permutation(num_labels)
+        for _ in range(self.num_batches):
+            if len(unvisited) == 0:
+                unvisited = np.random.permutation(num_labels)
+            labels, unvisited = unvisited[:self.labels_per_batch], unvisited[self.labels_per_batch:]
+            if len(labels) < self.labels_per_batch:
+                others = np.setdiff1d(np.arange(num_labels), labels)
+                labels = np.concatenate([labels, np.random.choice(others, self.labels_per_batch - len(labels),
+                                                                  replace=False)])
+            yield labels
+
+    def __iter__(self):
+        for batch_labels in self._epoch_labels():
+            batch = []
+            for label in batch_labels:
+                indices = self.label_to_indices[label]
+                if len(indices) < self.samples_per_label:
+                    picks = np.random.randint(len(indices), size=self.samples_per_label)
+                else:
+                    picks = np.random.permutation(len(indices))[:self.samples_per_label]
+                batch.extend(indices[picks].tolist())
+            yield batch
+
+
+def batch_semi_hard_triplet_loss(embeddings, labels, margin=TRIPLET_MARGIN):
+    """
+    Triplet loss mined inside the batch: for each anchor the hardest positive (farthest same-label sample)
+    and the closest negative that is still farther than it (semi-hard), falling back to the hardest negative.
+    """
+    dist = torch.cdist(embeddings, embeddings)
+    same = labels.unsqueeze(0) == labels.unsqueeze(1)
+    pos_mask = same & ~torch.eye(len(labels), dtype=torch.bool, device=labels.device)
+    neg_mask = ~same
 
-        if self.transform:
-            anchor_img = self.transform(anchor_img)
-            positive_img = self.transform(positive_img)
-            negative_img = self.transform(negative_img)
+    d_ap = dist.masked_fill(~pos_mask, float('-inf')).max(dim=1).values
+    d_semi = dist.masked_fill(~(neg_mask & (dist > d_ap.unsqueeze(1))), float('inf')).min(dim=1).values
+    d_hard = dist.masked_fill(~neg_mask, float('inf')).min(dim=1).values
+    d_an = torch.where(torch.isinf(d_semi), d_hard, d_semi)
 
-        return anchor_img, positive_img, negative_img
+    # Only anchors with at least one positive and one negative in the batch form a triplet
+    valid = pos_mask.any(dim=1) & neg_mask.any(dim=1)
+    return F.relu(d_ap[valid] - d_an[valid] + margin).mean()
 
 
-def augment_faces(face_data, classroom_id):
+class ImagePathDataset(Dataset):
     """
-    Augments face images with various transformations.
-    `face_data` is expected to be a list of dicts: `[{'image_path': '...', 'label': '...'}]`
+    Loads single images for embedding generation; unreadable files are flagged instead of raising.
+    With `num_views` > 1 the paths repeat, and every pass after the first uses `augment_transform`.
     """
-    print(f"Augmenting faces for classroom {classroom_id}...")
-    augmented_path_data = []
-    
-    # Specific directory for augmented images for this classroom
-    augmentation_output_dir = os.path.join(Config.DATASETS_FOLDER, classroom_id, "augmented")
-    os.makedirs(augmentation_output_dir, exist_ok=True)
-
-    augment_transforms = transforms.Compose([
-        transforms.RandomHorizontalFlip(),
-        transforms.RandomRotation(10),
-        transforms.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.1),
-        transforms.RandomPerspective(distortion_scale=0.1, p=0.5),
-        transforms.RandomResizedCrop(224, scale=(0.8, 1.0)), # Assuming input size for model is 224x224
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
-    ])
+    def __init__(self, records, transform, augment_transform=None, num_views=1):
+        self.paths = [record['image_path'] for record in records]
+        self.transform = transform
+        self.augment_transform = augment_transform
+        self.num_views = num_views
 
-    for face_info in tqdm(face_data, desc="Augmenting"):
-        original_img_path = face_info['image_path']
-        label = face_info['label']
+    def __len__(self):
+        return len(self.paths) * self.num_views
 
+    def __getitem__(self, idx):
+        path = self.paths[idx % len(self.paths)]
+        transform = self.transform if idx < len(self.paths) else self.augment_transform
         try:
-            face_img = Image.open(original_img_path).convert('RGB')
-        except FileNotFoundError:
-            print(f"Warning: Original face image not found for augmentation: {original_img_path}")
-            continue
-
-        num_augmentations = 5 # Generate 5 augmented images per original face
-
-        for i in range(num_augmentations):
-            augmented_face_tensor = augment_transforms(face_img)
-            # Convert tensor back to PIL Image (denormalize first for correct visual representation)
-            augmented_face_pil_save = transforms.ToPILImage()(augmented_face_tensor * 0.5 + 0.5)
+            img = Image.open(path).convert('RGB')
+            return transform(img), True
+        except Exception as e:
+            print(f"Error processing {path} for embedding: {e}")
+            return torch.zeros(3, IMAGE_SIZE, IMAGE_SIZE), False
 
-            aug_filename = f"{label}_aug_{i}.jpg"
-            aug_path = os.path.join(augmentation_output_dir, aug_filename)
-            augmented_face_pil_save.save(aug_path)
-            augmented_path_data.append({'image_path': aug_path, 'label': label})
 
-    print(f"Augmented images saved to {augmentation_output_dir}")
-    return augmented_path_data
+@contextmanager
+def tf32_matmuls():
+    """
+    Allows TF32 tensor cores for float32 matmuls while training, then restores the previous precision
+    so the inference server sharing this process keeps its own settings. (cuDNN convolutions use TF32 by default.)
+    """
+    previous = torch.get_float32_matmul_precision()
+    torch.set_float32_matmul_precision('high')
+    try:
+        yield
+    finally:
+        torch.set_float32_matmul_precision(previous)
 
 
+@tf32_matmuls()
 def train_siamese_network_for_classroom(classroom_id, num_epochs=20, batch_size=32):
     """
-    Trains the EnhancedSiameseNetwork for a specific classroom.
-    Collects all labeled face images (original + augmented) for training.
+    Trains the EnhancedSiameseNetwork for a specific classroom on all labeled face images.
+    Augmentation is applied on the fly, so no augmented copies are written to disk.
     """
     print(f"Initiating training for classroom {classroom_id}...")
 
     # Load all labeled faces for this classroom
     labeled_faces_dir = os.path.join(Config.DATASETS_FOLDER, classroom_id, "labeled_faces")
-    augmented_faces_dir = os.path.join(Config.DATASETS_FOLDER, classroom_id, "augmented")
 
     all_paths = []
     if os.path.exists(labeled_faces_dir):
         for filename in os.listdir(labeled_faces_dir):
-            if filename.lower().endswith(Config.ALLOWED_EXTENSIONS):
+            if os.path.splitext(filename)[1].lower() in Config.ALLOWED_EXTENSIONS:
                 label = os.path.splitext(filename)[0] # e.g., "Roll_001"
                 all_paths.append({'image_path': os.path.join(labeled_faces_dir, filename), 'label': label})
-    
-    if os.path.exists(augmented_faces_dir):
-        for filename in os.listdir(augmented_faces_dir):
-            if filename.lower().endswith(Config.ALLOWED_EXTENSIONS):
-                # Labels for augmented images are often like "Roll_001_aug_0.jpg"
-                label = os.path.splitext(filename)[0].rsplit('_aug', 1)[0] # Extract "Roll_001"
-                all_paths.append({'image_path': os.path.join(augmented_faces_dir, filename), 'label': label})
 
     if not all_paths:
-        raise ValueError(f"No labeled or augmented face data found for classroom {classroom_id}. Please assign roll numbers first.")
+        raise ValueError(f"No labeled face data found for classroom {classroom_id}. Please assign roll numbers first.")
 
-    path_df = pd.DataFrame(all_paths)
-
-    if len(path_df['label'].unique()) < 2:
+    if len({record['label'] for record in all_paths}) < 2:
         raise ValueError("Need at least two distinct individuals (labels) for Siamese network training.")
 
-    # Define transforms for training
+    # Random augmentations are drawn per sample at train time instead of saving augmented JPEGs.
+    # They run on the pre-decoded uint8 tensors, so no PIL work is left in the training loop
+    augment = transforms.Compose([
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomRotation(10),
+        transforms.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.1),
+        transforms.RandomPerspective(distortion_scale=0.1, p=0.5),
+        transforms.RandomResizedCrop(IMAGE_SIZE, scale=(0.8, 1.0), antialias=True),
+        transforms.ConvertImageDtype(torch.float32),
+        transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
+    ])
+    # Same augmentation for reference embeddings, which are loaded from disk as PIL images
+    augment_from_pil = transforms.Compose([
+        transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)),
+        transforms.PILToTensor(),
+        augment
+    ])
+    # Deterministic transform for reference embeddings
     transform = transforms.Compose([
-        transforms.Resize((224, 224)),
+        transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)),
         transforms.ToTensor(),
         transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
     ])
 
-    dataset = SiameseDataset(path_df, transform=transform)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers= 0)
+    dataset = SiameseDataset(all_paths, transform=augment)
+    # One labeled face per student, so size epochs as if each face had its augmented copies
+    batch_sampler = BalancedBatchSampler(dataset.label_ids, batch_size,
+                                         views_per_image=1 + AUGMENTED_VIEWS_PER_FACE)
+    # Augment in background workers so the GPU is not left waiting
+    dataloader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=min(8, NUM_CPUS),
+                            pin_memory=DEVICE == 'cuda', persistent_workers=True, prefetch_factor=4)
 
     model = EnhancedSiameseNetwork().to(DEVICE)
+    # Inductor fuses the pointwise ops after each GEMM; P x K batches keep the input shape fixed.
+    # Classroom-sized jobs finish faster eager, so compile only long runs.
+    # The uncompiled module is kept for saving so the state dict has no `_orig_mod.` prefix
+    use_compile = DEVICE == 'cuda' and num_epochs * len(batch_sampler) >= COMPILE_MIN_STEPS
+    train_model = torch.compile(model, dynamic=False) if use_compile else model
     optimizer = torch.optim.Adam(model.parameters(), lr=0.0005) # Slightly reduced learning rate
-    criterion = nn.TripletMarginLoss(margin=0.8) # Adjusted margin for potentially better separation
 
     model.train()
     print(f"Starting training for {num_epochs} epochs...")
     for epoch in range(num_epochs):
         total_loss = 0
         pbar = tqdm(dataloader, desc=f"Epoch {epoch+1}/{num_epochs}")
-        for anchor, positive, negative in pbar:
-            anchor, positive, negative = anchor.to(DEVICE), positive.to(DEVICE), negative.to(DEVICE)
+        for images, labels in pbar:
+            images, labels = images.to(DEVICE, non_blocking=True), labels.to(DEVICE, non_blocking=True)
 
             optimizer.zero_grad()
 
-            anchor_out = model(anchor)
-            positive_out = model(positive)
-            negative_out = model(negative)
-
-            loss = criterion(anchor_out, positive_out, negative_out)
+            # One forward for the whole P x K batch; triplets are mined from its distance matrix
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=USE_BF16):
+                embeddings = train_model(images)
+                loss = batch_semi_hard_triplet_loss(embeddings, labels)
             loss.backward()
             optimizer.step()
 
@@ -180,56 +258,66 @@ def train_siamese_network_for_classroom(classroom_id, num_epochs=20, batch_size=
     torch.save(model.state_dict(), model_path)
     print(f"Model saved to {model_path}")
 
-    # Generate and save embeddings
-    embedding_dict, label_embeddings = generate_embeddings(model, path_df, transform, classroom_id)
+    # Generate and save embeddings as stacked reference matrices
+    labels, avg_ref, max_ref, boundaries = generate_embeddings(model, all_paths, transform, classroom_id,
+                                                               augment_transform=augment_from_pil)
     embeddings_save_dir = os.path.join(Config.EMBEDDINGS_FOLDER, classroom_id)
     os.makedirs(embeddings_save_dir, exist_ok=True)
-    embedding_dict_path = os.path.join(embeddings_save_dir, 'embedding_dict.pkl')
-    label_embeddings_path = os.path.join(embeddings_save_dir, 'label_embeddings.pkl')
-    
-    with open(embedding_dict_path, 'wb') as f:
-        pickle.dump(embedding_dict, f)
-    with open(label_embeddings_path, 'wb') as f:
-        pickle.dump(label_embeddings, f)
-    print(f"Embeddings saved to {embeddings_save_dir}")
+    refs_path = os.path.join(embeddings_save_dir, 'refs.npz')
+    np.savez(refs_path, labels=labels, avg_ref=avg_ref, max_ref=max_ref, boundaries=boundaries)
+    print(f"Embeddings saved to {refs_path}")
 
     return {"status": "success", "message": "Training complete.", "model_path": model_path}
 
 
-def generate_embeddings(model, path_df, transform, classroom_id):
+def generate_embeddings(model, records, transform, classroom_id, augment_transform=None,
+                        num_augmentations=AUGMENTED_VIEWS_PER_FACE):
     """
     Generates and saves embeddings for all faces in the dataset for a given classroom.
     This function should be called after the model is trained.
+    `records` is expected to be a list of dicts: `[{'image_path': '...', 'label': '...'}]`
+    If `augment_transform` is given, `num_augmentations` augmented views per image are embedded as
+    extra references alongside the originals.
+    Returns `labels`, `avg_ref` (L x D, per-label mean), `max_ref` (all embeddings grouped by label)
+    and `boundaries`, the cumulative row count of each label's block in `max_ref`.
     """
     print(f"Generating embeddings for classroom {classroom_id}...")
-    embedding_dict = {} # Stores average embedding per label (e.g., Roll_001)
-    label_embeddings = {} # Stores all individual embeddings per label (for ensemble)
-
-    model.eval()
-    with torch.no_grad():
-        for _, row in tqdm(path_df.iterrows(), total=len(path_df), desc="Generating Embeddings"):
-            img_path = row['image_path']
-            label = row['label']
-
-            try:
-                img = Image.open(img_path).convert('RGB')
-                img_tensor = transform(img).unsqueeze(0).to(DEVICE)
-                embedding = model(img_tensor).squeeze().cpu().numpy()
-                embedding = embedding / np.linalg.norm(embedding) # L2 Normalize
-
-                if label not in label_embeddings:
-                    label_embeddings[label] = []
-                label_embeddings[label].append(embedding)
-
-            except Exception as e:
-                print(f"Error processing {img_path} for embedding: {e}")
-
-    # Compute average embeddings
-    for label, embeddings_list in label_embeddings.items():
-        if embeddings_list:
-            # Average and then L2 normalize the average
-            avg_emb = np.mean(embeddings_list, axis=0)
-            embedding_dict[label] = avg_emb / np.linalg.norm(avg_emb) if np.linalg.norm(avg_emb) > 0 else avg_emb
-            
-    print(f"Generated embeddings for {len(embedding_dict)} unique labels.")
-    return embedding_dict, label_embeddings
\ No newline at end of file
+
+    # Batched forward passes instead of one image at a time; the frozen backbone dominates the cost
+    num_views = 1 if augment_transform is None else 1 + num_augmentations
+    dataset = ImagePathDataset(records, transform, augment_transform, num_views)
+    dataloader = DataLoader(dataset, batch_size=EMBEDDING_BATCH_SIZE, shuffle=False, num_workers=min(4, NUM_CPUS),
+                            pin_memory=DEVICE == 'cuda')
+    embeddings = np.empty((len(dataset), model.embedding_layer.out_features), dtype=np.float32)
+    valid = np.empty(len(dataset), dtype=bool)
+
+    # The checkpoint is already saved, so the model can be folded for inference in place
+    model.fuse_for_inference()
+    # This one-shot pass is only a few batches, so it runs eager: compiling or capturing CUDA graphs
+    # would take longer than the launch overhead it saves
+    offset = 0
+    with torch.inference_mode(), torch.autocast(device_type='cuda', dtype=AMP_DTYPE, enabled=DEVICE == 'cuda'):
+        for images, ok in tqdm(dataloader, desc="Generating Embeddings"):
+            n = len(images)
+            batch_embeddings = model(images.to(DEVICE, non_blocking=True))
+            embeddings[offset:offset + n] = batch_embeddings.float().cpu().numpy()
+            valid[offset:offset + n] = ok.numpy()
+            offset += n
+
+    # Drop unreadable images; rows are already unit length since the model ends with F.normalize
+    embeddings = embeddings[valid]
+
+    # Group by label in one vectorized pass: per-label means (L2 normalized) and all embeddings
+    # stored contiguously per label for the ensemble
+    row_labels = np.tile(np.array([record['label'] for record in records], dtype=str), num_views)[valid]
+    labels, inverse = np.unique(row_labels, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(labels))
+    avg_ref = np.zeros((len(labels), embeddings.shape[1]), dtype=np.float32)
+    np.add.at(avg_ref, inverse, embeddings)
+    avg_ref /= counts[:, None]
+    norms = np.linalg.norm(avg_ref, axis=1, keepdims=True)
+    avg_ref = np.divide(avg_ref, norms, out=avg_ref, where=norms > 0)
+    max_ref = embeddings[np.argsort(inverse, kind='stable')]
+
+    print(f"Generated embeddings for {len(labels)} unique labels.")
+    return labels, avg_ref, max_ref, np.cumsum(counts)
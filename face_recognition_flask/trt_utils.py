@@ -0,0 +1,100 @@
+import os
+import threading
+import torch
+
+try:
+    import tensorrt as trt
+except ImportError:  # TensorRT is optional; recognition falls back to PyTorch
+    trt = None
+
+# Batch sizes the engine's optimization profile is built for
+ENGINE_MIN_BATCH = 1
+ENGINE_OPT_BATCH = 32
+ENGINE_MAX_BATCH = 128
+INPUT_SHAPE = (3, 224, 224)
+
+
+class TRTEmbeddingModel:
+    """Runs a serialized TensorRT engine as a drop-in replacement for EnhancedSiameseNetwork at inference."""
+
+    def __init__(self, engine_path):
+        logger = trt.Logger(trt.Logger.WARNING)
+        with open(engine_path, 'rb') as f:
+            self.engine = trt.Runtime(logger).deserialize_cuda_engine(f.read())
+        self.context = self.engine.create_execution_context()
+        # An execution context must not be used by two requests at once
+        self.lock = threading.Lock()
+
+    def __call__(self, batch):
+        batch = batch.to(device='cuda', dtype=torch.float32)
+        outputs = []
+        with self.lock:
+            for chunk in batch.split(ENGINE_MAX_BATCH):
+                chunk = chunk.contiguous()
+                self.context.set_input_shape('input', tuple(chunk.shape))
+                output = torch.empty(tuple(self.context.get_tensor_shape('embedding')),
+                                     device=chunk.device, dtype=torch.float32)
+                self.context.execute_v2([chunk.data_ptr(), output.data_ptr()])
+                outputs.append(output)
+        return torch.cat(outputs)
+
+
+def build_trt_engine(model, onnx_path, engine_path):
+    """Export the model to ONNX and build an FP16 TensorRT engine with a dynamic batch dimension."""
+    print(f"Exporting model to ONNX at {onnx_path}...")
+    dummy_input = torch.zeros(ENGINE_OPT_BATCH, *INPUT_SHAPE, device='cuda')
+    torch.onnx.export(
+        model, dummy_input, onnx_path,
+        opset_version=17,
+        input_names=['input'],
+        output_names=['embedding'],
+        dynamic_axes={'input': {0: 'batch'}, 'embedding': {0: 'batch'}}
+    )
+
+    print(f"Building FP16 TensorRT engine at {engine_path} (this can take a few minutes)...")
+    logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(logger)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, logger)
+    with open(onnx_path, 'rb') as f:
+        if not parser.parse(f.read()):
+            errors = "; ".join(str(parser.get_error(i)) for i in range(parser.num_errors))
+            raise RuntimeError(f"Failed to parse ONNX model: {errors}")
+
+    config = builder.create_builder_config()
+    config.set_flag(trt.BuilderFlag.FP16)
+    profile = builder.create_optimization_profile()
+    profile.set_shape('input',
+                      (ENGINE_MIN_BATCH, *INPUT_SHAPE),
+                      (ENGINE_OPT_BATCH, *INPUT_SHAPE),
+                      (ENGINE_MAX_BATCH, *INPUT_SHAPE))
+    config.add_optimization_profile(profile)
+
+    serialized_engine = builder.build_serialized_network(network, config)
+    if serialized_engine is None:
+        raise RuntimeError("TensorRT engine build failed.")
+    with open(engine_path, 'wb') as f:
+        f.write(serialized_engine)
+
+
+def load_trt_model(model, model_path):
+    """
+    Returns a TensorRT-backed callable for `model`, building the engine on first use and caching it
+    next to `model_path`. Returns None if TensorRT is unavailable or the engine cannot be built.
+    """
+    if trt is None:
+        print("TensorRT is not installed; using PyTorch for recognition.")
+        return None
+
+    base_path = os.path.splitext(model_path)[0]
+    onnx_path = f"{base_path}.onnx"
+    engine_path = f"{base_path}_fp16.engine"
+
+    try:
+        # Rebuild if the engine is missing or older than the trained weights
+        if not os.path.exists(engine_path) or os.path.getmtime(engine_path) < os.path.getmtime(model_path):
+            build_trt_engine(model, onnx_path, engine_path)
+        return TRTEmbeddingModel(engine_path)
+    except Exception as e:
+        print(f"TensorRT unavailable for {model_path}, falling back to PyTorch: {e}")
+        return None
@@ -53,6 +53,9 @@ current_embeddings = None
 current_label_embeddings = None
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+# Werkzeug debugger/reloader; off unless FLASK_DEBUG=true
+DEBUG = os.environ.get('FLASK_DEBUG', 'false').lower() == 'true'
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
 
@@ -61,6 +64,35 @@ def encode_image_to_base64(image_path):
     with open(image_path, "rb") as img_file:
         return base64.b64encode(img_file.read()).decode('utf-8')
 
+def read_request_image(default_filename):
+    """
+    Read the uploaded image as raw encoded bytes, either from a multipart `image` file
+    (no base64 overhead) or from a base64 `image_data` JSON field.
+    Returns (image_bytes, filename); image_bytes is None if no image was sent.
+    The client-supplied filename is sanitized, since it ends up in paths on disk.
+    """
+    if 'image' in request.files:
+        file = request.files['image']
+        image_bytes, filename = file.read(), file.filename
+    else:
+        data = request.get_json(silent=True) or {}
+        image_data = data.get('image_data')
+        if not image_data:
+            return None, default_filename
+        image_bytes, filename = base64.b64decode(image_data), data.get('filename')
+    return image_bytes, secure_filename(filename or '') or default_filename
+
+def decode_image(image_bytes):
+    """Decode encoded image bytes to a BGR array in memory; returns None if it is not a valid image"""
+    buf = np.frombuffer(image_bytes, np.uint8)
+    if buf.size == 0:
+        return None
+    return cv2.imdecode(buf, cv2.IMREAD_COLOR)
+
+def preview_base64(image_bytes):
+    """Short base64 preview of an image for mock responses"""
+    return base64.b64encode(image_bytes[:75]).decode('utf-8') + '...'
+
 def save_base64_image(base64_string, filename):
     """Save base64 string as image file"""
     img_data = base64.b64decode(base64_string)
@@ -82,13 +114,11 @@ def health_check():
 
 @app.route('/api/classrooms/<classroom_id>/upload-group-photo', methods=['POST'])
 def upload_group_photo(classroom_id):
-    """Upload group photo for a specific classroom"""
+    """Upload group photo for a specific classroom (multipart `image` file or base64 `image_data`)"""
     try:
-        data = request.get_json()
-        image_data = data.get('image_data')
-        filename = data.get('filename', 'group_photo.jpg')
+        image_bytes, filename = read_request_image('group_photo.jpg')
         
-        if not image_data:
+        if not image_bytes:
             return jsonify({'error': 'No image data provided'}), 400
         
         # Create classroom directory
@@ -96,15 +126,13 @@ def upload_group_photo(classroom_id):
         os.makedirs(classroom_dir, exist_ok=True)
         os.makedirs(os.path.join(classroom_dir, 'datasets'), exist_ok=True)
         
-        # Save image from base64
+        # Save the uploaded image bytes as-is
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         image_filename = f"group_photo_{timestamp}_{filename}"
         image_path = os.path.join(classroom_dir, 'datasets', image_filename)
         
-        # Decode and save image
-        img_data = base64.b64decode(image_data)
         with open(image_path, 'wb') as f:
-            f.write(img_data)
+            f.write(image_bytes)
         
         # TODO: Implement face detection using your face_recognition_utils
         # For now, return mock data
@@ -115,7 +143,7 @@ def upload_group_photo(classroom_id):
         for i in range(faces_detected):
             faces_for_labeling.append({
                 'face_id': i,
-                'image_base64': image_data[:100] + '...',  # Mock face image
+                'image_base64': preview_base64(image_bytes),  # Mock face image
                 'confidence': 0.95
             })
         
@@ -178,15 +206,17 @@ def train_classroom_model(classroom_id):
 
 @app.route('/api/classrooms/<classroom_id>/take-attendance', methods=['POST'])
 def take_attendance(classroom_id):
-    """Take attendance for a specific classroom"""
+    """Take attendance for a specific classroom (multipart `image` file or base64 `image_data`)"""
     try:
-        data = request.get_json()
-        image_data = data.get('image_data')
-        filename = data.get('filename', 'attendance.jpg')
+        image_bytes, filename = read_request_image('attendance.jpg')
         
-        if not image_data:
+        if not image_bytes:
             return jsonify({'error': 'No image data provided'}), 400
         
+        # Validate by decoding in memory; the attendance photo never touches the filesystem
+        if decode_image(image_bytes) is None:
+            return jsonify({'error': 'Could not decode the uploaded image'}), 400
+        
         # TODO: Implement attendance taking using your face_recognition_utils
         # For now, return mock attendance results
         
@@ -209,7 +239,7 @@ def take_attendance(classroom_id):
         return jsonify({
             'message': 'Attendance recorded successfully',
             'session_info': session_info,
-            'result_image': image_data[:100] + '...'  # Mock result image
+            'result_image': preview_base64(image_bytes)  # Mock result image
         })
         
     except Exception as e:
@@ -240,4 +270,4 @@ if __name__ == '__main__':
     print("  POST   /api/classrooms/{id}/take-attendance - Take attendance")
     print("  DELETE /api/classrooms/{id} - Delete classroom data")
     
-    app.run(host='0.0.0.0', port=8000, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=8000, debug=DEBUG, threaded=True)
\ No newline at end of file